@@ -10,12 +10,39 @@ import re
 import six
 import copy
 import glob
+import hashlib
 import json
-import yaml
 import click
 import importlib
 from emoji import emojize
+from packspec import __version__
 from collections import OrderedDict
+_COMMENT_RE = re.compile(r'^(?:\((.*)\))?(\w.*)$')
+_FEATURE_RE = re.compile(r'^(?:\((.*)\))?(?:([^=]*)=)?([^=].*)?$')
+_DOCUMENT_RE = re.compile(br'^(?:---|\.\.\.)', re.MULTILINE)
+_INTERP_RE = re.compile(r'{"([^{}]*?)": null}')
+_encode_json = json.JSONEncoder(ensure_ascii=False).encode
+_SPEC_SUFFIX = '.yml'
+try:
+    with io.open(__file__, 'rb') as file:
+        _CACHE_VERSION = '%s-%s' % (__version__, hashlib.sha1(file.read()).hexdigest())
+except (IOError, OSError):
+    _CACHE_VERSION = __version__
+_COMPILED_CACHE = OrderedDict()
+_COMPILED_CACHE_SIZE = 128
+_COMPILED_KEYS = ('package', 'features', 'code', 'stats')
+_COMPOSITE_TYPES = (tuple, list, dict)
+_RESET = '\x1b[0m'
+_BOLD = '\x1b[1m'
+_BOLD_GREEN = '\x1b[32m\x1b[1m'
+_BOLD_RED = '\x1b[31m\x1b[1m'
+_COMMENT = click.style(emojize('\n #  ', use_aliases=True))
+_SEPARATOR = click.style(emojize(':heavy_minus_sign:'*3, use_aliases=True))
+_SPEC_OK = click.style(emojize('\n :heavy_check_mark:  ', use_aliases=True), fg='green', bold=True)
+_SPEC_FAIL = click.style(emojize('\n :x:  ', use_aliases=True), fg='red', bold=True)
+_OK = click.style(emojize(' :heavy_check_mark:  ', use_aliases=True), fg='green')
+_FAIL = click.style(emojize(' :x:  ', use_aliases=True), fg='red')
+_SKIP = click.style(emojize(' :heavy_minus_sign:  ', use_aliases=True), fg='yellow')
 
 
 # Helpers
@@ -28,12 +55,13 @@ def parse_specs(path):
         if os.path.isfile(path):
             paths = [path]
         elif os.path.isdir(path):
-            paths = glob.glob('%s/*.yml' % path)
+            paths = list_spec_paths(path)
     if not path:
         if not paths:
             paths = glob.glob('packspec.yml')
         if not paths:
-            paths = glob.glob('packspec/*.yml')
+            if os.path.isdir('packspec'):
+                paths = list_spec_paths('packspec')
 
     # Specs
     specs = []
@@ -45,14 +73,74 @@ def parse_specs(path):
     return specs
 
 
+def list_spec_paths(directory):
+    if not hasattr(os, 'scandir'):
+        return glob.glob('%s/*%s' % (directory, _SPEC_SUFFIX))
+    paths = []
+    for entry in os.scandir(directory):
+        name = entry.name
+        if not name.endswith(_SPEC_SUFFIX) or name[0] == '.':
+            continue
+        if entry.is_file():
+            paths.append(entry.path)
+    return paths
+
+
 def parse_spec(path):
 
+    # Compiled
+    stat = os.stat(path)
+    source = [getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size]
+    compiled = read_compiled_spec(path, source)
+    if not compiled:
+        compiled = compile_spec(path)
+        write_compiled_spec(path, compiled, source)
+    if compiled['skip']:
+        return None
+
+    # Scope
+    scope = {}
+    scope['$import'] = builtin_import
+    if compiled['code']:
+        user_scope = {}
+        exec(compiled['code'], user_scope)
+        for name, attr in user_scope.items():
+            if name.startswith('_'):
+                continue
+            scope['$' + name] = attr
+
+    return {
+        'package': compiled['package'],
+        'features': compiled['features'],
+        'scope': scope,
+        'stats': compiled['stats'],
+    }
+
+
+def compile_spec(path):
+    contents = read_bytes(path)
+    digest = hashlib.sha1(contents).hexdigest()
+    compiled = _COMPILED_CACHE.pop(digest, None)
+    if compiled is None:
+        compiled = compile_contents(contents)
+    _COMPILED_CACHE[digest] = compiled
+    while len(_COMPILED_CACHE) > _COMPILED_CACHE_SIZE:
+        _COMPILED_CACHE.popitem(last=False)
+    return copy.deepcopy(compiled)
+
+
+def compile_contents(contents):
+    import yaml
+    Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
     # Package
-    contents = io.open(path, encoding='utf-8').read()
-    documents = list(yaml.load_all(contents))
+    if _DOCUMENT_RE.search(contents):
+        documents = list(yaml.load_all(contents, Loader=Loader))
+    else:
+        documents = [yaml.load(contents, Loader=Loader)]
     feature = parse_feature(documents[0][0])
     if feature['skip']:
-        return None
+        return {'skip': True}
     package = feature['comment']
 
     # Features
@@ -65,16 +153,10 @@ def parse_spec(path):
             skip = feature['skip']
         feature['skip'] = skip or feature['skip']
 
-    # Scope
-    scope = {}
-    scope['$import'] = builtin_import
+    # Code
+    code = None
     if len(documents) > 1 and documents[1].get('py'):
-        user_scope = {}
-        exec(documents[1].get('py'), user_scope)
-        for name, attr in user_scope.items():
-            if name.startswith('_'):
-                continue
-            scope['$%s' % name] = attr
+        code = documents[1].get('py')
 
     # Stats
     stats = {'features': 0, 'comments': 0, 'skipped': 0, 'tests': 0}
@@ -88,30 +170,123 @@ def parse_spec(path):
                 stats['skipped'] += 1
 
     return {
+        'skip': False,
         'package': package,
         'features': features,
-        'scope': scope,
+        'code': code,
         'stats': stats,
     }
 
 
+def read_bytes(path):
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+    try:
+        chunks = []
+        size = os.fstat(fd).st_size
+        while True:
+            chunk = os.read(fd, max(size, 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    return b''.join(chunks)
+
+
+def read_compiled_spec(path, source):
+    cache_path = '%s.cache.json' % path
+    try:
+        with io.open(cache_path, encoding='utf-8') as file:
+            compiled = decode_compiled_spec(file.read())
+    except (IOError, OSError, AttributeError, TypeError, ValueError):
+        return None
+    if not compiled.get('skip') and not all(key in compiled for key in _COMPILED_KEYS):
+        return None
+    if compiled.get('version') != _CACHE_VERSION or compiled.get('source') != source:
+        return None
+    return compiled
+
+
+def write_compiled_spec(path, compiled, source):
+    cache_path = '%s.cache.json' % path
+    try:
+        compiled = dict(compiled, version=_CACHE_VERSION, source=source)
+        contents = _encode_json(compiled)
+        if not is_identical_value(decode_compiled_spec(contents), compiled):
+            return
+        with io.open(cache_path, 'w', encoding='utf-8') as file:
+            file.write(six.text_type(contents))
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+
+
+def decode_compiled_spec(contents):
+    compiled = json.loads(contents, object_pairs_hook=OrderedDict)
+    if not isinstance(compiled, dict):
+        raise ValueError('Compiled spec is not a mapping')
+    features = compiled.get('features') or []
+    for index, feature in enumerate(features):
+        kwargs = feature.get('kwargs')
+        feature = features[index] = decode_mapping(feature)
+        if kwargs is not None:
+            feature['kwargs'] = OrderedDict((name, decode_mapping(item)) for name, item in kwargs.items())
+    return dict((key, item if key == 'features' else decode_mapping(item)) for key, item in compiled.items())
+
+
+def decode_mapping(value):
+    if isinstance(value, dict):
+        return dict((key, decode_mapping(item)) for key, item in value.items())
+    elif isinstance(value, list):
+        return [decode_mapping(item) for item in value]
+    return value
+
+
+def is_identical_value(left, right):
+    if isinstance(left, six.string_types) and isinstance(right, six.string_types):
+        return left == right
+    if type(left) is not type(right):
+        return False
+    if isinstance(left, dict):
+        if len(left) != len(right):
+            return False
+        for key, item in left.items():
+            if key not in right or not is_identical_value(item, right[key]):
+                return False
+        return True
+    if isinstance(left, list):
+        if len(left) != len(right):
+            return False
+        for left_item, right_item in zip(left, right):
+            if not is_identical_value(left_item, right_item):
+                return False
+        return True
+    return left == right
+
+
 def parse_feature(feature):
 
     # General
     if isinstance(feature, six.string_types):
-        match = re.match(r'^(?:\((.*)\))?(\w.*)$', feature)
+        match = _COMMENT_RE.match(feature)
         skip, comment = match.groups()
         if skip:
-            skip = 'py' not in skip.split('|')
+            skip = parse_skip(skip)
         return {'comment': comment, 'skip': skip}
-    left, right = list(feature.items())[0]
+    left, right = next(iter(feature.items()))
 
     # Left side
     call = False
-    match = re.match(r'^(?:\((.*)\))?(?:([^=]*)=)?([^=].*)?$', left)
-    skip, assign, property = match.groups()
+    if left[:1] in ('(', '='):
+        match = _FEATURE_RE.match(left)
+        skip, assign, property = match.groups()
+    else:
+        skip = None
+        assign, sep, property = left.partition('=')
+        if not sep or property.startswith('='):
+            assign, property = None, left
+        property = property or None
     if skip:
-        skip = 'py' not in skip.split('|')
+        skip = parse_skip(skip)
     if not assign and not property:
         raise Exception('Non-valid feature')
     if property:
@@ -128,7 +303,7 @@ def parse_feature(feature):
         result = None
         for item in right:
             if isinstance(item, dict) and len(item) == 1:
-                item_left, item_right = list(item.items())[0]
+                item_left, item_right = next(iter(item.items()))
                 if item_left == '==':
                     result = item_right
                     continue
@@ -140,17 +315,21 @@ def parse_feature(feature):
     # Text repr
     text = property
     if assign:
-        text = '%s = %s' % (assign, property or json.dumps(result, ensure_ascii=False))
+        text = assign + ' = ' + (property or _encode_json(result))
     if call:
-        items = []
-        for item in args:
-            items.append(json.dumps(item, ensure_ascii=False))
-        for name, item in kwargs.items():
-            items.append('%s=%s' % (name, json.dumps(item, ensure_ascii=False)))
-        text = '%s(%s)' % (text, ', '.join(items))
+        items = [_encode_json(item) for item in args]
+        items.extend(name + '=' + _encode_json(item) for name, item in kwargs.items())
+        text = text + '(' + ', '.join(items) + ')'
     if result and not assign:
-        text = '%s == %s' % (text, result if result == 'ERROR' else json.dumps(result, ensure_ascii=False))
-    text = re.sub(r'{"([^{}]*?)": null}', r'\1', text)
+        text = text + ' == ' + (result if result == 'ERROR' else _encode_json(result))
+    text = _INTERP_RE.sub(r'\1', text)
+
+    # Dereference
+    dereference = (
+        has_reference(args) or has_reference(kwargs) or has_reference(result) or
+        any(isinstance(item, (dict, list)) for item in args) or
+        any(isinstance(item, (dict, list)) for item in kwargs.values()) or
+        bool(assign) and isinstance(result, (dict, list)))
 
     return {
         'comment': None,
@@ -162,14 +341,21 @@ def parse_feature(feature):
         'kwargs': kwargs,
         'result': result,
         'text': text,
+        'property_names': property.split('.') if property else None,
+        'assign_names': assign.split('.') if assign else None,
+        'dereference': dereference,
     }
 
 
+def parse_skip(filters):
+    return 'py' not in filters.split('|')
+
+
 def test_specs(specs, exit_first=False):
 
     # Message
-    message = click.style(emojize('\n #  ', use_aliases=True))
-    message += click.style('Python\n', bold=True)
+    message = _COMMENT
+    message += _BOLD + 'Python\n' + _RESET
     click.echo(message)
 
     # Test specs
@@ -182,62 +368,68 @@ def test_specs(specs, exit_first=False):
 
 
 def test_spec(spec, exit_first=False):
+    output = io.StringIO()
 
     # Message
-    message = click.style(emojize(':heavy_minus_sign:'*3, use_aliases=True))
-    click.echo(message)
+    message = _SEPARATOR
+    echo_message(message, output)
 
     # Test spec
     passed = 0
-    for feature in spec['features']:
-        passed += test_feature(feature, spec['scope'], exit_first=exit_first)
+    try:
+        for feature in spec['features']:
+            passed += test_feature(feature, spec['scope'], exit_first=exit_first, output=output)
+    finally:
+        flush_messages(output)
     success = (passed == spec['stats']['features'])
 
     # Message
-    color = 'green'
-    message = click.style(emojize('\n :heavy_check_mark:  ', use_aliases=True), fg='green', bold=True)
+    style = _BOLD_GREEN
+    message = _SPEC_OK
     if not success:
-        color = 'red'
-        message = click.style(emojize('\n :x:  ', use_aliases=True), fg='red', bold=True)
-    message += click.style('%s: %s/%s\n' % (spec['package'], passed - spec['stats']['comments'] - spec['stats']['skipped'], spec['stats']['tests'] - spec['stats']['skipped']), bold=True, fg=color)
-    click.echo(message)
+        style = _BOLD_RED
+        message = _SPEC_FAIL
+    message += style + '%s: %s/%s\n' % (spec['package'], passed - spec['stats']['comments'] - spec['stats']['skipped'], spec['stats']['tests'] - spec['stats']['skipped']) + _RESET
+    echo_message(message, output)
+    flush_messages(output)
 
     return success
 
 
-def test_feature(feature, scope, exit_first=False):
+def test_feature(feature, scope, exit_first=False, output=None):
 
     # Comment
     if feature['comment']:
-        message = click.style(emojize('\n #  ', use_aliases=True))
-        message += click.style('%s\n' % feature['comment'], bold=True)
-        click.echo(message)
+        message = _COMMENT
+        message += _BOLD + feature['comment'] + '\n' + _RESET
+        echo_message(message, output)
         return True
 
     # Skip
     if feature['skip']:
-        message = click.style(emojize(' :heavy_minus_sign:  ', use_aliases=True), fg='yellow')
-        message += click.style('%s' % feature['text'])
-        click.echo(message)
+        message = _SKIP
+        message += feature['text'] + _RESET
+        echo_message(message, output)
         return True
 
     # Dereference
-    feature = copy.deepcopy(feature)
-    if feature['call']:
-        feature['args'] = dereference_value(feature['args'], scope)
-        feature['kwargs'] = dereference_value(feature['kwargs'], scope)
-    feature['result'] = dereference_value(feature['result'], scope)
+    args = feature['args']
+    kwargs = feature['kwargs']
+    expected = feature['result']
+    if feature['dereference']:
+        if feature['call']:
+            args = dereference_value(args, scope)
+            kwargs = dereference_value(kwargs, scope)
+        expected = dereference_value(expected, scope)
 
     # Execute
     exception = None
-    result = feature['result']
+    result = expected
     if feature['property']:
         try:
-            property = scope
-            for name in feature['property'].split('.'):
-                property = get_property(property, name)
+            property = resolve_property(scope, feature['property_names'])
             if feature['call']:
-                result = property(*feature['args'], **feature['kwargs'])
+                result = property(*args, **kwargs)
             else:
                 result = property
             result = normalize_value(result)
@@ -248,30 +440,31 @@ def test_feature(feature, scope, exit_first=False):
     # Assign
     if feature['assign']:
         owner = scope
-        names = feature['assign'].split('.')
+        names = feature['assign_names']
         for name in names[:-1]:
             owner = get_property(owner, name)
         set_property(owner, names[-1], result)
 
     # Compare
-    success = result == feature['result'] if feature['result'] is not None else result != 'ERROR'
+    success = (result is expected or result == expected) if expected is not None else result != 'ERROR'
     if success:
-        message = click.style(emojize(' :heavy_check_mark:  ', use_aliases=True), fg='green')
-        message += click.style('%s' % feature['text'])
-        click.echo(message)
+        message = _OK
+        message += feature['text'] + _RESET
+        echo_message(message, output)
     else:
         try:
             result_text = json.dumps(result)
         except TypeError:
             result_text = repr(result)
-        message = click.style(emojize(' :x:  ', use_aliases=True), fg='red')
-        message += click.style('%s\n' % feature['text'])
+        message = _FAIL
+        message += feature['text'] + '\n' + _RESET
         if exception:
-            message += click.style('Exception: %s' % exception, fg='red', bold=True)
+            message += _BOLD_RED + 'Exception: %s' % exception + _RESET
         else:
-            message += click.style('Assertion: %s != %s' % (result_text, json.dumps(feature['result'], ensure_ascii=False)), fg='red', bold=True)
-        click.echo(message)
+            message += _BOLD_RED + 'Assertion: %s != %s' % (result_text, _encode_json(expected)) + _RESET
+        echo_message(message, output)
         if exit_first:
+            flush_messages(output)
             click.echo('---')
             click.echo('Scope (current execution scope):')
             click.echo(list(scope))
@@ -284,6 +477,22 @@ def test_feature(feature, scope, exit_first=False):
     return success
 
 
+def echo_message(message, output=None):
+    if output is None:
+        click.echo(message)
+        return
+    output.write(message)
+    output.write('\n')
+
+
+def flush_messages(output):
+    if output is None:
+        return
+    click.echo(output.getvalue(), nl=False)
+    output.seek(0)
+    output.truncate()
+
+
 def builtin_import(package):
     attributes = {}
     module = importlib.import_module(package)
@@ -294,20 +503,49 @@ def builtin_import(package):
     return attributes
 
 
+def has_reference(value):
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            if len(value) == 1 and next(iter(value.values())) is None:
+                return True
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return False
+
+
 def dereference_value(value, scope):
-    value = copy.deepcopy(value)
-    if isinstance(value, dict) and len(value) == 1 and list(value.values())[0] is None:
-        result = scope
-        for name in list(value.keys())[0].split('.'):
-            result = get_property(result, name)
-        value = result
-    elif isinstance(value, dict):
-        for key, item in value.items():
-            value[key] = dereference_value(item, scope)
-    elif isinstance(value, list):
-        for index, item in enumerate(list(value)):
-            value[index] = dereference_value(item, scope)
-    return value
+    if not isinstance(value, (dict, list)):
+        return value
+    root = [value]
+    stack = [(root, 0)]
+    while stack:
+        owner, key = stack.pop()
+        value = owner[key]
+        if isinstance(value, dict):
+            if len(value) == 1:
+                reference, item = next(iter(value.items()))
+                if item is None:
+                    owner[key] = resolve_property(scope, reference.split('.'))
+                    continue
+            value = owner[key] = type(value)(value)
+            items = value.items()
+        else:
+            value = owner[key] = list(value)
+            items = enumerate(value)
+        for index, item in items:
+            if isinstance(item, (dict, list)):
+                stack.append((value, index))
+    return root[0]
+
+
+def resolve_property(scope, names):
+    property = scope.get(names[0])
+    for name in names[1:]:
+        property = get_property(property, name)
+    return property
 
 
 def get_property(owner, name):
@@ -329,15 +567,26 @@ def set_property(owner, name, value):
 
 
 def normalize_value(value):
-    if isinstance(value, tuple):
-        value = list(value)
-    elif isinstance(value, dict):
-        for key, item in value.items():
-            value[key] = normalize_value(item)
-    elif isinstance(value, list):
-        for index, item in enumerate(list(value)):
-            value[index] = normalize_value(item)
-    return value
+    if not isinstance(value, _COMPOSITE_TYPES):
+        return value
+    root = [value]
+    stack = [(root, 0)]
+    seen = set()
+    while stack:
+        owner, key = stack.pop()
+        value = owner[key]
+        if isinstance(value, tuple):
+            owner[key] = list(value)
+            continue
+        elif id(value) in seen:
+            continue
+        else:
+            seen.add(id(value))
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        for index, item in items:
+            if isinstance(item, _COMPOSITE_TYPES):
+                stack.append((value, index))
+    return root[0]
 
 
 # Main program
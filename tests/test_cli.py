@@ -1,25 +1,107 @@
+import copy
+import json
+import pytest
 from packspec import cli
 
 
+# Fixtures
+
+@pytest.fixture(scope='module')
+def base_specs(tmpdir_factory):
+    path = tmpdir_factory.mktemp('specs').join('packspec.yml')
+    with open('tests/packspec.yml') as file:
+        path.write(file.read())
+    return cli.parse_specs(str(path))
+
+
 # Tests
 
-def test_packspec():
-    specs = cli.parse_specs('tests/packspec.yml')
+def test_packspec(base_specs):
+    specs = copy.deepcopy(base_specs)
     valid = cli.test_specs(specs)
     assert valid
 
 
-def test_packspec_assertion_fail():
-    specs = cli.parse_specs('tests/packspec.yml')
+def test_packspec_assertion_fail(base_specs):
+    specs = copy.deepcopy(base_specs)
     specs[0]['features'] = specs[0]['features'][0:3]
     specs[0]['features'][2]['result'] = 'FAIL'
     valid = cli.test_specs(specs)
     assert not valid
 
 
-def test_packspec_exception_fail():
-    specs = cli.parse_specs('tests/packspec.yml')
+def test_packspec_exception_fail(base_specs):
+    specs = copy.deepcopy(base_specs)
     specs[0]['features'] = specs[0]['features'][0:3]
     specs[0]['features'][2]['call'] = True
     valid = cli.test_specs(specs)
     assert not valid
+
+
+def test_packspec_compiled_cache(tmpdir):
+    path = str(tmpdir.join('packspec.yml'))
+    with open('tests/packspec.yml') as file:
+        tmpdir.join('packspec.yml').write(file.read())
+    specs = cli.parse_specs(path)
+    assert tmpdir.join('packspec.yml.cache.json').check()
+    cached_specs = cli.parse_specs(path)
+    assert cached_specs[0]['features'] == specs[0]['features']
+    assert cached_specs[0]['stats'] == specs[0]['stats']
+    assert cli.test_specs(cached_specs)
+
+
+def test_packspec_compiled_cache_types(tmpdir):
+    path = str(tmpdir.join('packspec.yml'))
+    tmpdir.join('packspec.yml').write(
+        "- package\n"
+        "- mapping=: {'a': 1}\n"
+        "- $show: [{mapping}, ==: \"{'a': 1}\"]\n"
+        "- $show: [{nested: [{'a': 1}]}, ==: \"{'nested': [{'a': 1}]}\"]\n"
+        "---\n"
+        "py: |\n"
+        "  def show(value):\n"
+        "    return repr(value)\n")
+    assert cli.test_specs(cli.parse_specs(path))
+    assert tmpdir.join('packspec.yml.cache.json').check()
+    assert cli.test_specs(cli.parse_specs(path))
+
+
+def test_parse_feature_left_side():
+    for left in ['value=', 'value==', 'a.b', 'a=b.c', 'a=b==', '(py)a=b', '(xx|py)a==', '=a']:
+        feature = cli.parse_feature({left: []})
+        match = cli._FEATURE_RE.match(left)
+        skip, assign, property = match.groups()
+        assert feature['assign'] == assign
+        assert feature['property'] == (property[:-2] if property and property.endswith('==') else property)
+
+
+def test_parse_skip():
+    assert cli.parse_skip('py') is False
+    assert cli.parse_skip('js|py') is False
+    assert cli.parse_skip('js|rb') is True
+    assert cli.parse_skip('python') is True
+
+
+def test_packspec_compiled_cache_lossy(tmpdir):
+    path = str(tmpdir.join('packspec.yml'))
+    tmpdir.join('packspec.yml').write('- package\n- mapping==: {1: one}\n')
+    specs = cli.parse_specs(path)
+    assert not tmpdir.join('packspec.yml.cache.json').check()
+    assert specs[0]['features'][1]['result'] == {1: 'one'}
+
+
+def test_packspec_compiled_cache_malformed(tmpdir):
+    path = str(tmpdir.join('packspec.yml'))
+    tmpdir.join('packspec.yml').write('- package\n- value=: 1\n')
+    source = [1, 2]
+    partial = {'skip': False, 'features': [], 'version': cli._CACHE_VERSION, 'source': source}
+    for contents in ['[]', json.dumps(partial)]:
+        tmpdir.join('packspec.yml.cache.json').write(contents)
+        assert cli.read_compiled_spec(path, source) is None
+    specs = cli.parse_specs(path)
+    assert specs[0]['features'][1]['result'] == 1
+
+
+def test_normalize_value():
+    assert cli.normalize_value(((1, 2), [(3, 4)])) == [(1, 2), [(3, 4)]]
+    assert cli.normalize_value([(1, 2), {'key': (3, 4)}]) == [[1, 2], {'key': [3, 4]}]